@@ -1,6 +1,6 @@
 import os
 import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response
 from werkzeug.utils import secure_filename
 import json
 from utils import process_csv_with_ai
@@ -73,6 +73,20 @@ def index():
                 flash('No scoring sections defined')
                 return redirect(request.url)
             
+            # Optional previous job to rescore incrementally against, by task ID or results file
+            previous_task_id = request.form.get('previous_task_id', '').strip() or None
+            previous_results = None
+            previous_file = request.files.get('previous_results')
+            if previous_file and previous_file.filename:
+                if previous_task_id:
+                    flash('Enter either a previous task ID or a previous results file, not both')
+                    return redirect(request.url)
+                try:
+                    previous_results = load_previous_results(previous_file)
+                except ValueError:
+                    flash('Previous results file must be a results JSON downloaded from this tool')
+                    return redirect(request.url)
+            
             # Submit the job to the Celery task queue instead of processing synchronously
             try:
                 # Read CSV headers for later retrieval
@@ -88,7 +102,9 @@ def index():
                     filepath, 
                     scoring_sections, 
                     int(name_header_index),
-                    model_config
+                    model_config,
+                    previous_task_id=previous_task_id,
+                    previous_results=previous_results
                 )
                 
                 # Redirect to the progress page with task_id as URL parameter
@@ -102,7 +118,7 @@ def index():
             return redirect(request.url)
     
     # GET request - render the upload form
-    return render_template('index.html')
+    return render_template('index.html', previous_task_id=request.args.get('previous_task_id', ''))
 
 @app.route('/progress/<task_id>')
 def task_progress(task_id):
@@ -140,7 +156,9 @@ def task_status(task_id):
             'status': task.info.get('status', ''),
             'current': task.info.get('current', 0),
             'total': task.info.get('total', 100),
-            'percent': int(task.info.get('current', 0) / task.info.get('total', 100) * 100)
+            'percent': int(task.info.get('current', 0) / task.info.get('total', 100) * 100),
+            'concurrency_limit': task.info.get('concurrency_limit'),
+            'usage': task.info.get('usage')
         }
     elif task.state == 'SUCCESS':
         # Job completed successfully
@@ -150,7 +168,8 @@ def task_status(task_id):
             'current': 100,
             'total': 100,
             'percent': 100,
-            'result_url': url_for('results', task_id=task_id)
+            'result_url': url_for('results', task_id=task_id),
+            'usage': task.result.get('usage')
         }
     else:
         # Something unexpected happened
@@ -164,6 +183,32 @@ def task_status(task_id):
     
     return jsonify(response)
 
+def load_previous_results(file):
+    """
+    Read and validate an uploaded results JSON for incremental re-scoring.
+    
+    Args:
+        file: The uploaded file
+        
+    Returns:
+        list: The results list, one dict with a 'sections' list per candidate
+        
+    Raises:
+        ValueError: If the file is not JSON or not shaped like a results download
+    """
+    data = json.load(file)
+    results = data.get('results') if isinstance(data, dict) else None
+    
+    if not isinstance(results, list):
+        raise ValueError('results must be a list')
+    for candidate in results:
+        if not isinstance(candidate, dict) or not isinstance(candidate.get('sections'), list):
+            raise ValueError('each result must have a sections list')
+        if not all(isinstance(section, dict) for section in candidate['sections']):
+            raise ValueError('each section must be an object')
+    
+    return results
+
 def get_model_config_from_form(form_data):
     """
     Extract model configuration from form data.
@@ -228,6 +273,8 @@ def results(task_id):
     
     # Get results from the task
     results_data = task.result.get('results', [])
+    usage = task.result.get('usage')
+    reused_cells = task.result.get('reused_cells', 0)
     # Get headers from session (this is one piece of data we're still using from session)
     headers = session.get('headers', [])
     
@@ -235,7 +282,23 @@ def results(task_id):
         flash('No results available. Processing may have failed.')
         return redirect(url_for('index'))
     
-    return render_template('results.html', results=results_data, headers=headers, task_id=task_id)
+    return render_template('results.html', results=results_data, headers=headers, task_id=task_id, usage=usage,
+                           reused_cells=reused_cells)
+
+@app.route('/results/<task_id>/json')
+def results_json(task_id):
+    """Download a task's full results, including cell fingerprints, for incremental re-scoring"""
+    task = process_csv_task.AsyncResult(task_id)
+    
+    if not task or task.state != 'SUCCESS':
+        flash('Results not available. Please wait for processing to complete.')
+        return redirect(url_for('task_progress', task_id=task_id))
+    
+    return Response(
+        json.dumps(task.result),
+        mimetype='application/json',
+        headers={'Content-Disposition': f'attachment; filename=results_{task_id}.json'}
+    )
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
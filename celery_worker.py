@@ -1,7 +1,7 @@
 from celery import Celery
 import os
 from dotenv import load_dotenv
-from utils import process_csv_with_ai, configure_litellm, replace_placeholders_by_index, get_ai_score
+from utils import process_csv_with_ai, UsageTracker
 import pandas as pd
 import json
 import traceback
@@ -30,9 +30,13 @@ celery_app.conf.update(
 )
 
 @celery_app.task(bind=True)
-def process_csv_task(self, csv_filepath, scoring_sections, name_header_index, model_config):
+def process_csv_task(self, csv_filepath, scoring_sections, name_header_index, model_config,
+                     previous_task_id=None, previous_results=None):
     """
     Celery task to process CSV with AI scoring
+    
+    When previous_task_id or previous_results is given, only cells whose rendered
+    prompt, max marks or model changed are rescored; the rest are copied over.
     """
     # Update task state to STARTED
     self.update_state(
@@ -48,7 +52,6 @@ def process_csv_task(self, csv_filepath, scoring_sections, name_header_index, mo
         # Read the CSV to get total number of rows for progress tracking
         df = pd.read_csv(csv_filepath)
         total_rows = len(df)
-        headers = df.columns.tolist()
         
         # Update task state with total rows
         self.update_state(
@@ -60,45 +63,47 @@ def process_csv_task(self, csv_filepath, scoring_sections, name_header_index, mo
             }
         )
         
-        # Process the CSV with progress updates
-        results = []
+        # Load the earlier job's results for incremental re-scoring
+        if previous_task_id and previous_results is not None:
+            raise ValueError('Pass either previous_task_id or previous_results, not both')
+        if previous_task_id:
+            previous_task = process_csv_task.AsyncResult(previous_task_id)
+            if previous_task.state != 'SUCCESS':
+                raise Exception(f'Previous task {previous_task_id} has no results (state: {previous_task.state})')
+            previous_results = previous_task.result.get('results', [])
+        
+        # Token usage and cost are accumulated across all scoring calls of this job
+        usage = UsageTracker()
         
-        # Process each row separately and update progress
-        for i, (index, row) in enumerate(df.iterrows()):
-            # Update task state to track progress
+        # Report progress after each row, including the current adaptive concurrency limit
+        def report_progress(completed, total, result, concurrency_limit):
             self.update_state(
                 state='PROGRESS',
                 meta={
-                    'current': i,
-                    'total': total_rows,
-                    'status': f'Processing row {i+1} of {total_rows}: {row[headers[name_header_index]]}'
+                    'current': completed,
+                    'total': total,
+                    'concurrency_limit': concurrency_limit,
+                    'usage': usage.summary(),
+                    'status': f'Processed row {completed} of {total}: {result["name"]}'
                 }
             )
-            
-            # Handle individual row processing
-            try:
-                candidate_result = process_single_candidate(row, headers, name_header_index, scoring_sections, model_config)
-                results.append(candidate_result)
-            except Exception as e:
-                # Log the error but continue processing
-                error_msg = f"Error processing candidate {row[headers[name_header_index]]}: {str(e)}"
-                print(error_msg)
-                
-                # Add a placeholder with error message
-                candidate_results = {
-                    'name': row[headers[name_header_index]],
-                    'sections': [{'section_name': section['section_name'], 
-                                'score': 0, 
-                                'max_marks': section['max_marks']} 
-                                for section in scoring_sections],
-                    'error': str(e)
-                }
-                results.append(candidate_results)
+        
+        # Process the CSV; failed rows come back as placeholders with an 'error' message
+        results = process_csv_with_ai(csv_filepath, scoring_sections, name_header_index, model_config,
+                                      progress_callback=report_progress, usage=usage,
+                                      previous_results=previous_results)
+        
+        # Count how many cells were copied from the previous job rather than rescored
+        sections = [section for result in results for section in result['sections']]
+        reused_cells = sum(1 for section in sections if section.get('reused'))
         
         # Return the complete results
         return {
             'status': 'SUCCESS',
-            'results': results
+            'results': results,
+            'usage': usage.summary(),
+            'rescored_cells': len(sections) - reused_cells,
+            'reused_cells': reused_cells
         }
     
     except Exception as e:
@@ -110,34 +115,3 @@ def process_csv_task(self, csv_filepath, scoring_sections, name_header_index, mo
         # Re-raise the exception with more info
         # This will mark the task as failed
         raise Exception(error_message)
-
-def process_single_candidate(row, headers, name_header_index, scoring_sections, model_config):
-    """Process a single candidate (row) with AI scoring"""
-    candidate_results = {
-        'name': row[headers[name_header_index]],
-        'sections': []
-    }
-    
-    # Configure LiteLLM for this processing
-    configure_litellm(model_config)
-    model_string = model_config['model']
-    
-    for section in scoring_sections:
-        prompt_template = section['prompt']
-        section_name = section.get('section_name', 'Unnamed Section')
-        max_marks = section.get('max_marks', 10)
-        
-        # Replace placeholders in the prompt with actual values from the row
-        prompt = replace_placeholders_by_index(prompt_template, row, headers)
-        
-        # Process with AI model to get score
-        score = get_ai_score(prompt, max_marks, model_string)
-        
-        # Add section result
-        candidate_results['sections'].append({
-            'section_name': section_name,
-            'score': score,
-            'max_marks': max_marks
-        })
-    
-    return candidate_results
\ No newline at end of file
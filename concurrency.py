@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+class AdaptiveConcurrencyController:
+    """
+    AIMD (additive increase, multiplicative decrease) limit on in-flight model calls.
+    
+    Calls are grouped into windows of roughly `limit` completions. A healthy
+    window raises the limit by one; a window containing rate limiting (429)
+    or timeouts, a low success rate, or a p95 latency well above the baseline
+    multiplies the limit by `backoff_factor`. The limit is only raised when
+    the window actually had `limit` calls in flight at once, so it reflects
+    load the provider has handled. Caller errors (4xx other than 408/429)
+    say nothing about capacity and are left out. After a latency backoff the
+    baseline is reset to the p95 that triggered it, so a lasting change in
+    latency costs one backoff and steady error-free traffic lets the limit
+    climb again.
+    """
+    
+    def __init__(self, initial_limit=None, min_limit=1, max_limit=None,
+                 backoff_factor=0.5, latency_tolerance=1.5, min_success_rate=0.95):
+        self.min_limit = min_limit
+        self.max_limit = max_limit or int(os.getenv('AI_MAX_CONCURRENCY', 32))
+        self.limit = max(min_limit, min(self.max_limit, initial_limit or int(os.getenv('AI_INITIAL_CONCURRENCY', 4))))
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.min_success_rate = min_success_rate
+        
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._latencies = []
+        self._failures = 0
+        self._overloads = 0
+        self._peak_in_flight = 0
+        self._baseline_p95 = None
+        # Bumped on every backoff so calls started under the old limit don't trigger another one
+        self._epoch = 0
+    
+    @contextmanager
+    def slot(self):
+        """Hold one in-flight slot for the duration of a model call and record its outcome."""
+        epoch = self.acquire()
+        start = time.monotonic()
+        failed = overloaded = counted = False
+        try:
+            yield
+            counted = True
+        except Exception as e:
+            failed = counted = is_provider_error(e)
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            latency = time.monotonic() - start if counted else None
+            self.release(latency, epoch, failed=failed, overloaded=overloaded)
+    
+    def acquire(self):
+        """Block until a call may start under the current limit and return the current epoch."""
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+            return self._epoch
+    
+    def release(self, latency, epoch, failed=False, overloaded=False):
+        """
+        Record a finished call and adjust the limit once a window is complete.
+        
+        A latency of None frees the slot without recording a sample, for calls
+        that failed because of the request rather than the provider.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            
+            if latency is not None and epoch == self._epoch:
+                self._latencies.append(latency)
+                self._failures += failed
+                self._overloads += overloaded
+                
+                if len(self._latencies) >= max(self.limit, 4):
+                    self._adjust()
+            
+            self._condition.notify_all()
+    
+    def _adjust(self):
+        """Apply AIMD to the current window. Must be called with the lock held."""
+        latencies = sorted(self._latencies)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        success_rate = 1 - self._failures / len(latencies)
+        
+        slow = self._baseline_p95 is not None and p95 > self._baseline_p95 * self.latency_tolerance
+        if self._overloads or success_rate < self.min_success_rate:
+            self.limit = max(self.min_limit, int(self.limit * self.backoff_factor))
+            self._epoch += 1
+        elif slow:
+            self.limit = max(self.min_limit, int(self.limit * self.backoff_factor))
+            self._epoch += 1
+            # Re-baseline on the latency just observed: if it persists (e.g. longer prompts,
+            # slower provider) later windows count as healthy and the limit can grow again
+            self._baseline_p95 = p95
+        else:
+            # Only probe higher if the current limit was actually reached
+            if self._peak_in_flight >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1)
+            # Track the best latency seen, drifting slowly upwards so the baseline follows the provider
+            if self._baseline_p95 is None or p95 < self._baseline_p95:
+                self._baseline_p95 = p95
+            else:
+                self._baseline_p95 = 0.9 * self._baseline_p95 + 0.1 * p95
+        
+        self._latencies = []
+        self._failures = 0
+        self._overloads = 0
+        self._peak_in_flight = self._in_flight
+
+def is_overload_error(error):
+    """
+    Check whether an exception means the provider is overloaded (rate limited or timed out).
+    
+    Args:
+        error (Exception): The exception raised by a model call
+    
+    Returns:
+        bool: True for 429 responses and timeouts
+    """
+    if isinstance(error, TimeoutError):
+        return True
+    # LiteLLM's RateLimitError carries 429 and its Timeout carries 408
+    return getattr(error, 'status_code', None) in (408, 429)
+
+def is_provider_error(error):
+    """
+    Check whether an exception points at the provider rather than the request.
+    
+    Args:
+        error (Exception): The exception raised by a model call
+    
+    Returns:
+        bool: True for overload errors, 5xx responses and connection failures
+    """
+    if is_overload_error(error) or isinstance(error, ConnectionError):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(status_code, int) and status_code >= 500
@@ -0,0 +1,147 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from concurrency import AdaptiveConcurrencyController, is_overload_error, is_provider_error
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+def run_window(controller, latency, failed=False, overloaded=False):
+    """Complete exactly one adjustment window, keeping the limit saturated, with the same outcome for every call."""
+    remaining = max(controller.limit, 4)
+    while remaining:
+        epochs = [controller.acquire() for _ in range(min(controller.limit, remaining))]
+        for epoch in epochs:
+            controller.release(latency, epoch, failed=failed, overloaded=overloaded)
+        remaining -= len(epochs)
+
+
+def test_healthy_windows_increase_limit():
+    controller = AdaptiveConcurrencyController(initial_limit=4, max_limit=32)
+    for _ in range(5):
+        run_window(controller, 0.5)
+    assert controller.limit == 9
+
+
+def test_limit_capped_at_max():
+    controller = AdaptiveConcurrencyController(initial_limit=4, max_limit=6)
+    for _ in range(10):
+        run_window(controller, 0.5)
+    assert controller.limit == 6
+
+
+def test_rate_limit_halves_limit():
+    controller = AdaptiveConcurrencyController(initial_limit=8, max_limit=32)
+    run_window(controller, 0.5, failed=True, overloaded=True)
+    assert controller.limit == 4
+
+
+def test_backoff_never_below_min_limit():
+    controller = AdaptiveConcurrencyController(initial_limit=2, min_limit=1, max_limit=32)
+    for _ in range(5):
+        run_window(controller, 0.5, failed=True, overloaded=True)
+    assert controller.limit == 1
+
+
+def test_calls_started_before_backoff_do_not_back_off_again():
+    controller = AdaptiveConcurrencyController(initial_limit=8, max_limit=32)
+    first = [controller.acquire() for _ in range(8)]
+    for epoch in first[:7]:
+        controller.release(0.5, epoch, failed=True, overloaded=True)
+    # These start under the old limit and are still in flight when the backoff happens
+    stale = [controller.acquire() for _ in range(7)]
+    controller.release(0.5, first[7], failed=True, overloaded=True)
+    assert controller.limit == 4
+    for epoch in stale:
+        controller.release(0.5, epoch, failed=True, overloaded=True)
+    assert controller.limit == 4
+
+
+def test_sustained_latency_rise_recovers():
+    controller = AdaptiveConcurrencyController(initial_limit=4, max_limit=32)
+    run_window(controller, 0.5)
+    # Latency doubles for good; one backoff is expected, then the limit must climb again
+    for _ in range(100):
+        run_window(controller, 1.0)
+    assert controller.limit == 32
+
+
+def test_latency_spike_backs_off():
+    controller = AdaptiveConcurrencyController(initial_limit=4, max_limit=32)
+    run_window(controller, 0.5)
+    limit = controller.limit
+    run_window(controller, 2.0)
+    assert controller.limit == limit // 2
+
+
+def test_slot_records_overload_and_reraises():
+    controller = AdaptiveConcurrencyController(initial_limit=8, max_limit=32)
+    for _ in range(8):
+        with pytest.raises(RateLimited):
+            with controller.slot():
+                raise RateLimited()
+    assert controller.limit == 4
+
+
+def test_unsaturated_windows_do_not_raise_limit():
+    controller = AdaptiveConcurrencyController(initial_limit=8, max_limit=32)
+    # Only two calls are ever in flight, e.g. a small job
+    for _ in range(20):
+        epochs = [controller.acquire() for _ in range(2)]
+        for epoch in epochs:
+            controller.release(0.5, epoch)
+    assert controller.limit == 8
+
+
+def test_caller_errors_do_not_back_off():
+    controller = AdaptiveConcurrencyController(initial_limit=4, max_limit=32)
+    # Every other call is rejected with a 400, e.g. a model without JSON mode
+    for _ in range(5):
+        for _ in range(4):
+            with pytest.raises(BadRequest):
+                with controller.slot():
+                    raise BadRequest()
+        run_window(controller, 0.5)
+    assert controller.limit == 9
+
+
+def test_server_errors_back_off():
+    class ServerError(Exception):
+        status_code = 503
+    
+    controller = AdaptiveConcurrencyController(initial_limit=8, max_limit=32)
+    for _ in range(8):
+        with pytest.raises(ServerError):
+            with controller.slot():
+                raise ServerError()
+    assert controller.limit == 4
+
+
+def test_is_provider_error():
+    assert is_provider_error(RateLimited())
+    assert is_provider_error(ConnectionError())
+    assert not is_provider_error(BadRequest())
+    assert not is_provider_error(ValueError())
+
+
+def test_is_overload_error():
+    assert is_overload_error(RateLimited())
+    assert is_overload_error(TimeoutError())
+    assert not is_overload_error(ValueError())
+
+
+def test_is_overload_error_with_litellm_exceptions():
+    litellm = pytest.importorskip('litellm')
+    assert is_overload_error(litellm.RateLimitError('rate limited', llm_provider='openai', model='gpt-4o'))
+    assert is_overload_error(litellm.Timeout('timed out', model='gpt-4o', llm_provider='openai'))
+    assert not is_overload_error(litellm.BadRequestError('bad request', model='gpt-4o', llm_provider='openai'))
@@ -0,0 +1,107 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('litellm')
+pytest.importorskip('dotenv')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from utils import UsageTracker, build_scoring_messages, get_cached_tokens, split_prompt_template
+
+
+def test_split_joins_back_to_template():
+    template = "Rate the answer for clarity.\nAnswer: {2}\nContext: {3}"
+    rubric, row_template = split_prompt_template(template)
+    assert rubric + row_template == template
+    assert rubric == "Rate the answer for clarity.\nAnswer: "
+    assert row_template == "{2}\nContext: {3}"
+
+
+def test_split_without_placeholders_is_all_rubric():
+    assert split_prompt_template("Score this.") == ("Score this.", '')
+
+
+def test_rubric_stays_out_of_user_message():
+    rubric, row_template = split_prompt_template("Rate the answer for clarity.\nAnswer: {1}")
+    system, user = build_scoring_messages("some answer", 10, rubric)
+    assert "Rate the answer for clarity." in system['content']
+    assert "Maximum marks: 10" in system['content']
+    assert user['content'] == "some answer"
+    assert "clarity" not in user['content']
+
+
+def test_system_message_shared_across_rows():
+    first = build_scoring_messages("answer one", 10, "Rubric text")
+    second = build_scoring_messages("answer two", 10, "Rubric text")
+    assert first[0] == second[0]
+    assert first[1] != second[1]
+
+
+def test_claude_models_mark_prefix_for_caching():
+    system, _ = build_scoring_messages("answer", 10, "Rubric text", model='anthropic/claude-3-haiku-20240307')
+    assert system['content'][0]['cache_control'] == {"type": "ephemeral"}
+    assert "Rubric text" in system['content'][0]['text']
+
+    system, _ = build_scoring_messages("answer", 10, "Rubric text", model='openai/gpt-4o')
+    assert isinstance(system['content'], str)
+
+
+def test_cached_tokens_openai_shape():
+    usage = SimpleNamespace(prompt_tokens_details=SimpleNamespace(cached_tokens=80))
+    assert get_cached_tokens(usage) == 80
+
+
+def test_cached_tokens_anthropic_shape():
+    usage = SimpleNamespace(prompt_tokens_details=None, cache_read_input_tokens=64)
+    assert get_cached_tokens(usage) == 64
+
+
+def test_cached_tokens_missing():
+    assert get_cached_tokens(SimpleNamespace()) == 0
+
+
+def make_response(prompt_tokens, completion_tokens, cached_tokens):
+    return SimpleNamespace(usage=SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens)
+    ))
+
+
+def test_usage_tracker_totals(monkeypatch):
+    monkeypatch.setattr(utils.litellm, 'completion_cost', lambda completion_response, model: 0.5)
+    monkeypatch.setattr(utils.litellm, 'cost_per_token',
+                        lambda model, prompt_tokens, completion_tokens: (0.7, 0.1))
+    tracker = UsageTracker()
+    tracker.record(make_response(100, 5, 80), 'openai/gpt-4o')
+    tracker.record(make_response(100, 5, 0), 'openai/gpt-4o')
+
+    summary = tracker.summary()
+    assert summary['requests'] == 2
+    assert summary['prompt_tokens'] == 200
+    assert summary['completion_tokens'] == 10
+    assert summary['cached_tokens'] == 80
+    assert summary['cache_hit_rate'] == 0.4
+    assert summary['cost'] == 1.0
+    assert summary['cost_without_cache'] == 1.6
+    assert summary['cache_savings'] == 0.6
+
+
+def test_usage_tracker_counts_tokens_when_pricing_fails(monkeypatch):
+    def no_pricing(*args, **kwargs):
+        raise Exception('model not mapped')
+
+    monkeypatch.setattr(utils.litellm, 'completion_cost', no_pricing)
+    monkeypatch.setattr(utils.litellm, 'cost_per_token', no_pricing)
+    tracker = UsageTracker()
+    tracker.record(make_response(100, 5, 80), 'custom/model')
+
+    summary = tracker.summary()
+    assert summary['prompt_tokens'] == 100
+    assert summary['cached_tokens'] == 80
+    assert summary['cost'] == 0
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('litellm')
+pytest.importorskip('dotenv')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from utils import cell_fingerprint, index_previous_results, process_single_row
+
+HEADERS = ['name', 'answer']
+SECTIONS = [
+    {'section_name': 'Clarity', 'prompt': 'Rate clarity. Answer: {1}', 'max_marks': 10},
+    {'section_name': 'Depth', 'prompt': 'Rate depth. Answer: {1}', 'max_marks': 5},
+]
+
+
+def test_fingerprint_is_stable():
+    assert cell_fingerprint('answer', 10, 'openai/gpt-4o', 'Rubric') == \
+        cell_fingerprint('answer', 10, 'openai/gpt-4o', 'Rubric')
+
+
+@pytest.mark.parametrize('changed', [
+    ('other answer', 10, 'openai/gpt-4o', 'Rubric'),
+    ('answer', 5, 'openai/gpt-4o', 'Rubric'),
+    ('answer', 10, 'anthropic/claude-3-haiku-20240307', 'Rubric'),
+    ('answer', 10, 'openai/gpt-4o', 'Other rubric'),
+])
+def test_fingerprint_changes_with_inputs(changed):
+    assert cell_fingerprint(*changed) != cell_fingerprint('answer', 10, 'openai/gpt-4o', 'Rubric')
+
+
+def section(fingerprint, score, **extra):
+    return dict({'section_name': 'S', 'score': score, 'max_marks': 10, 'fingerprint': fingerprint}, **extra)
+
+
+def test_index_previous_results_keeps_scored_cells():
+    previous = [{'name': 'a', 'sections': [section('f1', 7), section('f2', 3.5)]}]
+    assert index_previous_results(previous) == {'f1': 7, 'f2': 3.5}
+
+
+def test_index_previous_results_skips_rows_with_error():
+    previous = [{'name': 'a', 'sections': [section('f1', 7)], 'error': 'Clarity: boom'}]
+    assert index_previous_results(previous) == {}
+
+
+def test_index_previous_results_skips_failed_and_malformed_cells():
+    previous = [{'name': 'a', 'sections': [
+        section('f1', 0, error='auth failed'),
+        {'section_name': 'S', 'fingerprint': 'f2'},
+        section('f3', 'seven'),
+        section('f4', None),
+        {'section_name': 'S', 'score': 4},
+    ]}]
+    assert index_previous_results(previous) == {}
+
+
+def test_unchanged_cells_are_copied(monkeypatch):
+    calls = []
+    monkeypatch.setattr(utils, 'get_ai_score', lambda prompt, *args: calls.append(prompt) or 5)
+    row = {'name': 'x', 'answer': 'hello'}
+    first = process_single_row(row, HEADERS, 0, SECTIONS, 'openai/gpt-4o', {})
+
+    sections = [SECTIONS[0], dict(SECTIONS[1], prompt='Rate depth carefully. Answer: {1}')]
+    second = process_single_row(row, HEADERS, 0, sections, 'openai/gpt-4o', {},
+                                previous_scores=index_previous_results([first]))
+    assert [s['reused'] for s in second['sections']] == [True, False]
+    assert len(calls) == 3
+
+
+def test_failed_calls_are_flagged_and_not_reused(monkeypatch):
+    def failing_score(*args):
+        raise Exception('invalid api key')
+
+    monkeypatch.setattr(utils, 'get_ai_score', failing_score)
+    row = {'name': 'x', 'answer': 'hello'}
+    result = process_single_row(row, HEADERS, 0, SECTIONS, 'openai/gpt-4o', {})
+
+    assert result['error']
+    assert all(s['error'] == 'invalid api key' and s['score'] == 0 for s in result['sections'])
+    assert index_previous_results([result]) == {}
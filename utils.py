@@ -2,17 +2,38 @@ import os
 import pandas as pd
 import re
 import json
+import hashlib
 import asyncio
 import concurrent.futures
+import threading
+import time
+import random
 from litellm import completion
 import litellm
 from dotenv import load_dotenv
 from functools import partial
+from concurrency import AdaptiveConcurrencyController, is_overload_error
 
 # Load environment variables
 load_dotenv()
 
-def process_csv_with_ai(csv_filepath, scoring_sections, name_header_index, model_config):
+# Seconds to wait for a single model response before treating it as a timeout
+REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', 60))
+
+# Retries for rate-limited or timed-out calls, with exponential backoff from OVERLOAD_RETRY_DELAY seconds
+OVERLOAD_RETRIES = int(os.getenv('AI_OVERLOAD_RETRIES', 4))
+OVERLOAD_RETRY_DELAY = float(os.getenv('AI_OVERLOAD_RETRY_DELAY', 1))
+
+# Static instructions shared by every scoring call; keep them first so they form a cacheable prefix
+SCORING_INSTRUCTIONS = """You are an assessment AI. Your task is to evaluate the input in the user message against the rubric below and provide a score between 0 and the maximum marks.
+Your evaluation should be fair, consistent, and based on the content of the answer."""
+
+STRUCTURED_OUTPUT_INSTRUCTIONS = """You must return a JSON object with a 'score' property containing only the numeric score. For example: {"score": 8.5}"""
+
+TEXT_OUTPUT_INSTRUCTIONS = """Return only a numeric value (or a float with up to 2 decimal places)."""
+
+def process_csv_with_ai(csv_filepath, scoring_sections, name_header_index, model_config, progress_callback=None,
+                        usage=None, previous_results=None):
     """
     Process a CSV file with AI scoring based on the defined scoring sections using LiteLLM.
     
@@ -25,6 +46,11 @@ def process_csv_with_ai(csv_filepath, scoring_sections, name_header_index, model
             - model: Model identifier string
             - api_key: API key for the service
             - api_base: (Optional) Base URL for custom API endpoints
+        progress_callback (callable): (Optional) Called as
+            progress_callback(completed, total, result, concurrency_limit) after each row
+        usage (UsageTracker): (Optional) Tracker accumulating the job's token usage and cost
+        previous_results (list): (Optional) Results of an earlier job; cells whose fingerprint
+            is unchanged are copied from it instead of being rescored
     
     Returns:
         list: List of dictionaries containing results for each candidate
@@ -33,54 +59,27 @@ def process_csv_with_ai(csv_filepath, scoring_sections, name_header_index, model
     df = pd.read_csv(csv_filepath)
     headers = df.columns.tolist()
     
-    # Configure LiteLLM based on the model type
-    configure_litellm(model_config)
-    
     # Get the model string to use with LiteLLM
     model_string = model_config['model']
     
-    # For small datasets (less than 20 rows), use the synchronous approach
-    if len(df) < 20:
-        return process_csv_sync(df, headers, name_header_index, scoring_sections, model_string, model_config)
-    
-    # For larger datasets, use the concurrent approach
-    return process_csv_concurrent(df, headers, name_header_index, scoring_sections, model_string, model_config)
+    # Concurrency is governed by the adaptive controller rather than a fixed row threshold
+    return process_csv_concurrent(df, headers, name_header_index, scoring_sections, model_string, model_config,
+                                  progress_callback=progress_callback, usage=usage,
+                                  previous_scores=index_previous_results(previous_results))
 
-def process_csv_sync(df, headers, name_header_index, scoring_sections, model_string, model_config):
-    """Synchronous processing for small datasets"""
-    results = []
-    
-    for index, row in df.iterrows():
-        candidate_results = {
-            'name': row[headers[name_header_index]],
-            'sections': []
-        }
-        
-        for section in scoring_sections:
-            prompt_template = section['prompt']
-            section_name = section.get('section_name', 'Unnamed Section')
-            max_marks = section.get('max_marks', 10)
-            
-            # Replace placeholders in the prompt with actual values from the row
-            prompt = replace_placeholders_by_index(prompt_template, row, headers)
-            
-            # Process with AI model via LiteLLM
-            score = get_ai_score(prompt, max_marks, model_string)
-            
-            # Add section result
-            candidate_results['sections'].append({
-                'section_name': section_name,
-                'score': score,
-                'max_marks': max_marks
-            })
-        
-        results.append(candidate_results)
+def process_csv_concurrent(df, headers, name_header_index, scoring_sections, model_string, model_config,
+                           progress_callback=None, controller=None, usage=None, previous_scores=None):
+    """
+    Concurrent processing using ThreadPoolExecutor.
     
-    return results
-
-def process_csv_concurrent(df, headers, name_header_index, scoring_sections, model_string, model_config):
-    """Concurrent processing for larger datasets using ThreadPoolExecutor"""
-    results = []
+    The thread pool only bounds the number of rows in progress; the number of
+    in-flight model calls is decided by an AdaptiveConcurrencyController.
+    """
+    if controller is None:
+        controller = AdaptiveConcurrencyController()
+    
+    total = len(df)
+    results = [None] * total
     
     # Create a partial function with fixed parameters
     process_row_func = partial(
@@ -89,84 +88,269 @@ def process_csv_concurrent(df, headers, name_header_index, scoring_sections, mod
         name_header_index=name_header_index,
         scoring_sections=scoring_sections,
         model_string=model_string,
-        model_config=model_config
+        model_config=model_config,
+        controller=controller,
+        usage=usage,
+        previous_scores=previous_scores
     )
     
     # Process rows concurrently using ThreadPoolExecutor
-    with concurrent.futures.ThreadPoolExecutor(max_workers=min(10, len(df))) as executor:
-        # Submit all rows for processing
-        future_to_row = {executor.submit(process_row_func, row): idx for idx, row in df.iterrows()}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(controller.max_limit, total))) as executor:
+        # Submit all rows for processing, remembering their position in the file
+        future_to_position = {executor.submit(process_row_func, row): position
+                              for position, (idx, row) in enumerate(df.iterrows())}
         
         # Collect results as they complete
-        for future in concurrent.futures.as_completed(future_to_row):
+        for completed, future in enumerate(concurrent.futures.as_completed(future_to_position), start=1):
+            position = future_to_position[future]
             try:
                 result = future.result()
-                results.append(result)
             except Exception as exc:
                 print(f'Row processing generated an exception: {exc}')
                 # Add a placeholder for failed processing
-                idx = future_to_row[future]
-                results.append({
-                    'name': df.iloc[idx][headers[name_header_index]],
+                result = {
+                    'name': df.iloc[position][headers[name_header_index]],
                     'sections': [{'section_name': section['section_name'], 
                                   'score': 0, 
                                   'max_marks': section['max_marks']} 
                                 for section in scoring_sections],
                     'error': str(exc)
-                })
-    
-    # Sort results by original order
-    results.sort(key=lambda x: df[df[headers[name_header_index]] == x['name']].index[0])
+                }
+            results[position] = result
+            
+            if progress_callback:
+                progress_callback(completed, total, result, controller.limit)
     
     return results
 
-def process_single_row(row, headers, name_header_index, scoring_sections, model_string, model_config):
+def process_single_row(row, headers, name_header_index, scoring_sections, model_string, model_config, controller=None,
+                       usage=None, previous_scores=None):
     """Process a single row (candidate) with AI scoring"""
     candidate_results = {
         'name': row[headers[name_header_index]],
         'sections': []
     }
     
-    # Configure LiteLLM for this thread
-    configure_litellm(model_config)
+    # Credentials go with each call; changing LiteLLM's globals would race between row threads
+    credentials = get_completion_credentials(model_config)
     
     for section in scoring_sections:
         prompt_template = section['prompt']
         section_name = section.get('section_name', 'Unnamed Section')
         max_marks = section.get('max_marks', 10)
         
-        # Replace placeholders in the prompt with actual values from the row
-        prompt = replace_placeholders_by_index(prompt_template, row, headers)
+        # Keep the static rubric in the shared prefix and fill in only the per-row part
+        rubric, row_template = split_prompt_template(prompt_template)
+        prompt = replace_placeholders_by_index(row_template, row, headers)
         
-        # Process with AI model via LiteLLM
-        score = get_ai_score(prompt, max_marks, model_string)
+        # Reuse the previous score if nothing that feeds into this cell has changed
+        fingerprint = cell_fingerprint(prompt, max_marks, model_string, rubric)
+        reused = bool(previous_scores) and fingerprint in previous_scores
+        error = None
+        if reused:
+            score = previous_scores[fingerprint]
+        else:
+            try:
+                # Process with AI model via LiteLLM
+                score = get_ai_score(prompt, max_marks, model_string, controller, rubric, usage, credentials)
+            except Exception as e:
+                # Keep scoring the other sections, but flag the cell so it is never reused
+                score, error = 0, str(e)
+                candidate_results['error'] = f"{section_name}: {error}"
         
         # Add section result
-        candidate_results['sections'].append({
+        section_result = {
             'section_name': section_name,
             'score': score,
-            'max_marks': max_marks
-        })
+            'max_marks': max_marks,
+            'fingerprint': fingerprint,
+            'reused': reused
+        }
+        if error:
+            section_result['error'] = error
+        candidate_results['sections'].append(section_result)
     
     return candidate_results
 
-def configure_litellm(model_config):
+def cell_fingerprint(prompt, max_marks, model, rubric=''):
     """
-    Configure LiteLLM based on the model configuration.
+    Hash everything that determines the score of one (row, section) cell.
     
     Args:
-        model_config (dict): Model configuration including type, model name, API key, etc.
+        prompt (str): The per-row content
+        max_marks (int or float): Maximum marks for this section
+        model (str): The model identifier to use with LiteLLM
+        rubric (str): (Optional) Static section text
+    
+    Returns:
+        str: Hex digest identifying the cell
+    """
+    payload = json.dumps({
+        'model': model,
+        'max_marks': max_marks,
+        'messages': build_scoring_messages(prompt, max_marks, rubric)
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def index_previous_results(previous_results):
+    """
+    Map cell fingerprints to scores from an earlier job's results.
+    
+    Rows and cells that failed in the earlier job, and entries without a
+    numeric score, are skipped so they get rescored.
+    
+    Args:
+        previous_results (list): Results list as returned by process_csv_with_ai
+    
+    Returns:
+        dict: Fingerprint to score
+    """
+    previous_scores = {}
+    for candidate in previous_results or []:
+        if candidate.get('error'):
+            continue
+        for section in candidate.get('sections', []):
+            score = section.get('score')
+            if section.get('error') or not isinstance(score, (int, float)) or isinstance(score, bool):
+                continue
+            if section.get('fingerprint'):
+                previous_scores[section['fingerprint']] = score
+    return previous_scores
+
+class UsageTracker:
+    """
+    Thread-safe running totals of token usage and cost for one job.
+    
+    Cached tokens are prompt tokens the provider served from its prefix cache;
+    `cost_without_cache` prices every prompt token at the full rate so the
+    savings from caching can be compared against `cost`.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.cost_without_cache = 0.0
+        self._pricing_warned = False
+    
+    def record(self, response, model):
+        """Add the usage reported on a LiteLLM response to the totals."""
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        cached_tokens = get_cached_tokens(usage)
+        
+        # Pricing is unknown for some custom models; keep counting tokens regardless
+        try:
+            cost = litellm.completion_cost(completion_response=response, model=model)
+            prompt_cost, completion_cost = litellm.cost_per_token(
+                model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            cost_without_cache = prompt_cost + completion_cost
+        except Exception as e:
+            if not self._pricing_warned:
+                print(f"Could not price response for {model}: {str(e)}")
+                self._pricing_warned = True
+            cost = cost_without_cache = 0.0
+        
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_tokens += cached_tokens
+            self.cost += cost
+            self.cost_without_cache += cost_without_cache
+    
+    def summary(self):
+        """Return the totals as a JSON-serialisable dict."""
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'cached_tokens': self.cached_tokens,
+                'cache_hit_rate': round(self.cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0,
+                'cost': round(self.cost, 6),
+                'cost_without_cache': round(self.cost_without_cache, 6),
+                'cache_savings': round(max(0.0, self.cost_without_cache - self.cost), 6)
+            }
+
+def get_cached_tokens(usage):
     """
-    # Reset any previous configuration
-    litellm.api_key = None
-    litellm.api_base = None
+    Read the number of cached prompt tokens from a response's usage block.
+    
+    Providers report this differently: OpenAI-style responses use
+    prompt_tokens_details.cached_tokens, Anthropic uses cache_read_input_tokens.
     
-    # Set the API key directly on LiteLLM
-    litellm.api_key = model_config.get('api_key')
+    Args:
+        usage: The usage object from a LiteLLM response
     
-    # If it's a custom model with an API base, set that too
+    Returns:
+        int: Cached prompt tokens, or 0 if not reported
+    """
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, 'cache_read_input_tokens', None)
+    return cached or 0
+
+def run_completion(controller=None, usage=None, **kwargs):
+    """
+    Call LiteLLM's completion, holding a slot on the concurrency controller if one is given.
+    
+    Rate limiting and timeouts are retried up to OVERLOAD_RETRIES times with
+    exponential backoff, re-acquiring a slot under the (by then lowered) limit.
+    The last overload error is raised rather than turned into a score.
+    
+    Args:
+        controller (AdaptiveConcurrencyController): (Optional) Controller limiting in-flight calls
+        usage (UsageTracker): (Optional) Tracker the response's token usage is recorded on
+        **kwargs: Arguments passed through to litellm.completion
+    
+    Returns:
+        The LiteLLM response
+    """
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    for attempt in range(OVERLOAD_RETRIES + 1):
+        try:
+            if controller is None:
+                response = completion(**kwargs)
+            else:
+                with controller.slot():
+                    response = completion(**kwargs)
+            break
+        except Exception as e:
+            if not is_overload_error(e) or attempt == OVERLOAD_RETRIES:
+                raise
+            # Give the controller's backoff time to take effect before trying again
+            time.sleep(OVERLOAD_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+    
+    if usage is not None:
+        usage.record(response, kwargs.get('model'))
+    return response
+
+def get_completion_credentials(model_config):
+    """
+    Build the per-call LiteLLM credential arguments from the model configuration.
+    
+    Args:
+        model_config (dict): Model configuration including type, model name, API key, etc.
+    
+    Returns:
+        dict: api_key, plus api_base for custom models, to pass to completion
+    """
+    credentials = {'api_key': model_config.get('api_key')}
+    
+    # If it's a custom model with an API base, pass that too
     if model_config.get('model_type') == 'custom' and model_config.get('api_base'):
-        litellm.api_base = model_config.get('api_base')
+        credentials['api_base'] = model_config.get('api_base')
+    
+    return credentials
 
 def replace_placeholders_by_index(prompt_template, row, headers):
     """
@@ -197,58 +381,117 @@ def replace_placeholders_by_index(prompt_template, row, headers):
     
     return prompt
 
-def get_ai_score(prompt, max_marks, model):
+def split_prompt_template(prompt_template):
+    """
+    Split a section prompt into its static rubric and the per-row part.
+    
+    Everything before the first {index} placeholder is identical for every row,
+    so it can live in the cached prompt prefix.
+    
+    Args:
+        prompt_template (str): The prompt template with {index} placeholders
+    
+    Returns:
+        tuple: (rubric, row_template) whose concatenation is the original template
+    """
+    match = re.search(r'\{\d+\}', prompt_template)
+    if not match:
+        return prompt_template, ''
+    return prompt_template[:match.start()], prompt_template[match.start():]
+
+def build_scoring_messages(prompt, max_marks, rubric='', output_instructions=None, model=None):
+    """
+    Assemble chat messages with the shared content first and the per-row content last.
+    
+    The system message starts with instructions common to every call, followed
+    by the section's max marks and rubric, so provider-side prefix caching can
+    reuse it across all rows of a section. Only the user message varies per row.
+    Claude models (Anthropic, Bedrock, Vertex) only cache explicitly marked
+    prefixes, so for them the system message carries a cache_control block.
+    
+    Args:
+        prompt (str): The per-row content
+        max_marks (int or float): Maximum marks for this section
+        rubric (str): (Optional) Static section text
+        output_instructions (str): (Optional) How the model should format its answer
+        model (str): (Optional) The model identifier, used to decide on cache_control
+    
+    Returns:
+        list: Messages for LiteLLM's completion
+    """
+    system_message = f"""{SCORING_INSTRUCTIONS}
+{output_instructions or STRUCTURED_OUTPUT_INSTRUCTIONS}
+
+Maximum marks: {max_marks}
+
+Rubric:
+{rubric.strip()}"""
+    
+    user_message = prompt.strip() or "Score according to the rubric above."
+    
+    if model and 'claude' in model.lower():
+        system_message = [{
+            "type": "text",
+            "text": system_message,
+            "cache_control": {"type": "ephemeral"}
+        }]
+    
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": user_message}
+    ]
+
+def get_ai_score(prompt, max_marks, model, controller=None, rubric='', usage=None, credentials=None):
     """
     Get a score for the given prompt using LiteLLM.
     
     Args:
-        prompt (str): The prompt to send to the AI model
+        prompt (str): The per-row content to send to the AI model
         max_marks (int or float): Maximum marks for this section
         model (str): The model identifier to use with LiteLLM
+        controller (AdaptiveConcurrencyController): (Optional) Controller limiting in-flight calls
+        rubric (str): (Optional) Static section text placed in the shared prompt prefix
+        usage (UsageTracker): (Optional) Tracker accumulating token usage and cost
+        credentials (dict): (Optional) api_key/api_base passed to each completion call
     
     Returns:
         float: The score assigned by the AI model
     """
     try:
-        # First try with structured JSON output
-        return get_structured_score(prompt, max_marks, model)
+        # Structured JSON output, which falls back to text-based scoring on its own
+        return get_structured_score(prompt, max_marks, model, controller, rubric, usage, credentials)
     except Exception as e:
+        # Both approaches failed (or the call stayed overloaded after retries); the caller marks the cell
         print(f"Error with structured scoring: {str(e)}")
-        # Fall back to text-based scoring if JSON parsing fails
-        return get_prompt_score(prompt, max_marks, model)
+        raise
 
-def get_structured_score(prompt, max_marks, model):
+def get_structured_score(prompt, max_marks, model, controller=None, rubric='', usage=None, credentials=None):
     """
     Get a score using JSON structured output.
     
     Args:
-        prompt (str): The prompt to send to the AI model
+        prompt (str): The per-row content to send to the AI model
         max_marks (int or float): Maximum marks for this section
         model (str): The model identifier to use with LiteLLM
+        controller (AdaptiveConcurrencyController): (Optional) Controller limiting in-flight calls
+        rubric (str): (Optional) Static section text placed in the shared prompt prefix
+        usage (UsageTracker): (Optional) Tracker accumulating token usage and cost
+        credentials (dict): (Optional) api_key/api_base passed to each completion call
     
     Returns:
         float: The score assigned by the AI model
     """
-    # Construct the system and user messages
-    system_message = f"""You are an assessment AI. Your task is to evaluate answers based on prompts and provide a score between 0 and {max_marks}.
-    Your evaluation should be fair, consistent, and based on the content of the answer.
-    You must return a JSON object with a 'score' property containing only the numeric score. For example: {{"score": 8.5}}"""
-    
-    user_message = f"""Based on the following input, provide a score between 0 and {max_marks}:
-    
-    {prompt}"""
-    
     try:
         # Call the model with JSON object format
-        response = completion(
+        response = run_completion(
+            controller,
+            usage,
             model=model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
+            messages=build_scoring_messages(prompt, max_marks, rubric, STRUCTURED_OUTPUT_INSTRUCTIONS, model),
             response_format={"type": "json_object"},
             temperature=0.3,
-            max_tokens=100
+            max_tokens=100,
+            **(credentials or {})
         )
         
         # Extract the JSON result
@@ -263,39 +506,41 @@ def get_structured_score(prompt, max_marks, model):
         # If there's an issue with the JSON response, try to extract score from text
         return extract_score_from_text(response.choices[0].message.content, max_marks)
     except Exception as e:
+        if is_overload_error(e):
+            raise
         # For all other errors, fall back to prompt-based scoring
         print(f"Error with structured output: {str(e)}")
-        return get_prompt_score(prompt, max_marks, model)
+        return get_prompt_score(prompt, max_marks, model, controller, rubric, usage, credentials)
 
-def get_prompt_score(prompt, max_marks, model):
+def get_prompt_score(prompt, max_marks, model, controller=None, rubric='', usage=None, credentials=None):
     """
     Get a score using traditional prompt engineering.
     
     Args:
-        prompt (str): The prompt to send to the AI model
+        prompt (str): The per-row content to send to the AI model
         max_marks (int or float): Maximum marks for this section
         model (str): The model identifier to use with LiteLLM
+        controller (AdaptiveConcurrencyController): (Optional) Controller limiting in-flight calls
+        rubric (str): (Optional) Static section text placed in the shared prompt prefix
+        usage (UsageTracker): (Optional) Tracker accumulating token usage and cost
+        credentials (dict): (Optional) api_key/api_base passed to each completion call
     
     Returns:
         float: The score assigned by the AI model
-    """
-    # Construct the full prompt with instructions
-    full_prompt = f"""
-    Based on the following input, provide a score between 0 and {max_marks}.
-    Return only a numeric value (or a float with up to 2 decimal places).
     
-    Input: {prompt}
-    
-    Score (0-{max_marks}):
+    Raises:
+        Exception: If the call fails, so the cell is marked rather than scored 0
     """
-    
     try:
         # Call the AI model
-        response = completion(
+        response = run_completion(
+            controller,
+            usage,
             model=model,
-            messages=[{"role": "user", "content": full_prompt}],
+            messages=build_scoring_messages(prompt, max_marks, rubric, TEXT_OUTPUT_INSTRUCTIONS, model),
             temperature=0.3,  # Lower temperature for more consistent scoring
-            max_tokens=10     # We only need a short response
+            max_tokens=10,    # We only need a short response
+            **(credentials or {})
         )
         
         # Extract the score from the response
@@ -303,7 +548,7 @@ def get_prompt_score(prompt, max_marks, model):
         return extract_score_from_text(score_text, max_marks)
     except Exception as e:
         print(f"Error with prompt-based scoring: {str(e)}")
-        return 0  # Return 0 in case of errors
+        raise
 
 def extract_score_from_text(text, max_marks):
     """